@@ -0,0 +1,75 @@
+import asyncio
+
+from vedirect_core import VEDirectProtocol
+
+
+def make_frame(fields, checksum_byte):
+    # Bouw een VE.Direct-blok dat eindigt op de gevraagde checksum-byte, door een
+    # opvulveld zo te kiezen dat de som van alle bytes (mod 256) nul wordt.
+    body = b"".join(b"\r\n" + k + b"\t" + v for k, v in fields)
+    tail = b"\r\nChecksum\t" + bytes([checksum_byte])
+    need = (-(sum(body) + sum(b"\r\nFILL\t") + sum(tail))) & 0xFF
+    n = 1
+    while True:
+        for total in range(65 * n, 90 * n + 1):
+            if total & 0xFF == need:
+                fill = bytearray(b"A" * n)
+                rest = total - 65 * n
+                for i in range(n):
+                    step = min(rest, 25)
+                    fill[i] += step
+                    rest -= step
+                return b"\r\nFILL\t" + bytes(fill) + body + tail
+        n += 1
+
+
+def run_protocol(stream, chunk_size, validate_checksum=True):
+    frames = []
+
+    async def feed():
+        proto = VEDirectProtocol(lambda f: frames.append(dict(f)), validate_checksum)
+        for i in range(0, len(stream), chunk_size):
+            proto.data_received(stream[i:i + chunk_size])
+
+    asyncio.run(feed())
+    return frames
+
+
+def test_checksum_byte_newline_does_not_break_validation(capsys):
+    checksums = (0x50, 0x51, 0x0A, 0x52, 0x53, 0x54)
+    stream = b"".join(
+        make_frame([(b"PID", b"0xA053"), (b"V", b"%d" % (12800 + i)), (b"HSDS", b"5")], c)
+        for i, c in enumerate(checksums)
+    )
+    for chunk_size in (1, 7, len(stream)):
+        frames = run_protocol(stream, chunk_size)
+        assert [f["V"] for f in frames] == [
+            b"%d" % (12800 + i) for i in range(len(checksums))
+        ]
+    assert "Checksum mismatch" not in capsys.readouterr().out
+
+
+def test_corrupted_frame_is_dropped(capsys):
+    good = make_frame([(b"V", b"12800")], 0x41)
+    bad = bytearray(make_frame([(b"V", b"12801")], 0x42))
+    bad[bad.index(b"12801")] ^= 0x01
+    frames = run_protocol(good + bytes(bad) + good, 5)
+    assert [f["V"] for f in frames] == [b"12800", b"12800"]
+    assert "Checksum mismatch" in capsys.readouterr().out
+
+
+def test_trailing_checksum_after_hsds_is_not_a_separate_frame():
+    stream = b"".join(
+        make_frame([(b"PID", b"0xA053"), (b"V", b"12800"), (b"HSDS", b"5")], c)
+        for c in (0x50, 0x51)
+    )
+    frames = run_protocol(stream, 7, validate_checksum=False)
+    assert len(frames) == 2
+    assert all("HSDS" in f for f in frames)
+
+
+def test_checksum_value_is_not_part_of_the_frame():
+    stream = make_frame([(b"V", b"12800")], 0xC3) + make_frame([(b"V", b"12801")], 0x41)
+    frames = run_protocol(stream, 3)
+    assert [f["V"] for f in frames] == [b"12800", b"12801"]
+    assert not any("Checksum" in f for f in frames)
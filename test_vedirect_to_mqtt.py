@@ -0,0 +1,39 @@
+import vedirect_to_mqtt
+
+
+class RecordingClient:
+    def __init__(self):
+        self.sent = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.sent.append((topic, payload, qos, retain))
+        return type("Info", (), {"rc": 0})()
+
+
+def setup_publish(monkeypatch, **config):
+    client = RecordingClient()
+    monkeypatch.setattr(vedirect_to_mqtt, "client", client)
+    monkeypatch.setattr(vedirect_to_mqtt, "_TOPIC_CACHE", {})
+    monkeypatch.setattr(vedirect_to_mqtt, "_stale_retained", set())
+    monkeypatch.setattr(vedirect_to_mqtt, "_last_published", {})
+    for name, value in config.items():
+        monkeypatch.setattr(vedirect_to_mqtt, name, value)
+    return client
+
+
+def test_clear_retained_goes_out_before_the_first_value(monkeypatch):
+    client = setup_publish(monkeypatch, CLEAR_RETAINED=True, PUBLISH_RETAIN=True,
+                           RETAIN_KEYS=frozenset({"PID"}), PUBLISH_JSON=False)
+    vedirect_to_mqtt.publish_frame({"PID": b"0xA053", "ERR": b"0"})
+    vedirect_to_mqtt.publish_frame({"PID": b"0xA053", "ERR": b"0"})
+
+    err = [m for m in client.sent if m[0] == "victron/mppt/ERR"]
+    assert err == [("victron/mppt/ERR", b"", 0, True), ("victron/mppt/ERR", b"0", 0, False)]
+    assert not any(m[0] == "victron/mppt/PID" and m[1] == b"" for m in client.sent)
+
+
+def test_no_retained_clear_without_migration_flag(monkeypatch):
+    client = setup_publish(monkeypatch, CLEAR_RETAINED=False, PUBLISH_RETAIN=True,
+                           RETAIN_KEYS=frozenset({"PID"}), PUBLISH_JSON=False)
+    vedirect_to_mqtt.publish_frame({"PID": b"0xA053", "ERR": b"0"})
+    assert not any(m[1] == b"" for m in client.sent)
@@ -0,0 +1,112 @@
+# VE.Direct tekstprotocol: regels knippen, key/values verzamelen en complete
+# frames afleveren. Los van MQTT, zodat elk entry-script alleen nog bepaalt
+# wat er met een frame gebeurt en hoe een frame eindigt.
+import sys
+import time
+import asyncio
+
+# Keys die een frame afsluiten; de spec schrijft 'Checksum', varianten voor de zekerheid
+_CHECKSUM_KEYS = frozenset({"Checksum", "checksum", "CHECKSUM"})
+_END_KEYS      = _CHECKSUM_KEYS | {"HSDS"}
+_CHECKSUM_KEYS_B = frozenset(k.encode("ascii") for k in _CHECKSUM_KEYS)
+
+# ---------- Helpers ----------
+def parse_kv(raw: bytes):
+    # VE.Direct: b"KEY\tVALUE\r" — direct op bytes; key als str, value blijft bytes
+    # zodat hij zonder encode als MQTT-payload meekan
+    i = raw.find(b"\t")
+    if i < 0:
+        return None, None
+    return raw[:i].strip().decode("ascii", errors="ignore"), raw[i + 1:].strip()
+
+# ---------- VE.Direct protocol ----------
+class VEDirectProtocol(asyncio.Protocol):
+    """Knipt binnenkomende seriële data in regels en bouwt daar frames van.
+
+    on_frame(frame_kv) wordt aangeroepen voor elk compleet frame; de dict wordt
+    daarna hergebruikt, dus kopiëren als hij bewaard moet blijven.
+    """
+
+    def __init__(self, on_frame, validate_checksum: bool = False, max_lines: int = 128):
+        self.on_frame = on_frame
+        self.validate_checksum = validate_checksum
+        self.max_lines = max_lines
+        # met checksum-validatie eindigt een frame alleen op 'Checksum'
+        self.end_keys = _CHECKSUM_KEYS if validate_checksum else _END_KEYS
+        self.rxbuf = b""
+        self.frame_kv = {}
+        self.line_count = 0
+        self.lrc = 0   # lopende 8-bit som van alle bytes in het frame (VE.Direct checksum)
+        self.last_line_ts = time.monotonic()
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def reset_frame(self):
+        self.frame_kv.clear()
+        self.line_count = 0
+        self.lrc = 0
+
+    def data_received(self, data):
+        # Splits complete regels af, bewaar de onvolledige staart voor de volgende read.
+        # Als bytes (niet bytearray) zodat de values onveranderlijke payloads zijn.
+        # De checksum telt elke ruwe byte van de stream mee. De checksum-regel eindigt
+        # na precies één byte na 'Checksum\t', ook als die byte zelf '\n' is (0x0A).
+        buf = self.rxbuf + data
+        start = 0
+        got_line = False
+        while True:
+            nl = buf.find(b"\n", start)
+            tab = buf.find(b"\t", start)
+            if tab >= 0 and (nl < 0 or tab < nl) and buf[start:tab].strip() in _CHECKSUM_KEYS_B:
+                if tab + 1 >= len(buf):
+                    break   # checksum-byte nog niet binnen
+                end = tab + 2
+            elif nl >= 0:
+                end = nl + 1
+            else:
+                break
+            raw = buf[start:end]
+            self.lrc = (self.lrc + sum(raw)) & 0xFF
+            self.handle_line(raw)
+            start = end
+            got_line = True
+        self.rxbuf = buf[start:]
+
+        if got_line:
+            self.last_line_ts = time.monotonic()
+
+    def handle_line(self, raw: bytes):
+        key, val = parse_kv(raw)
+        # Keys die we niet willen publiceren (leeg, of bevatten # of *) meteen overslaan
+        if not key or "#" in key or "*" in key:
+            return
+
+        # Bewaar key/value; geïnterneerde keys maken latere dict-lookups goedkoper.
+        # De 'Checksum'-waarde is een willekeurige (binaire) byte en geen meetwaarde:
+        # die sluit alleen het frame af en komt niet in frame_kv.
+        key = sys.intern(key)
+        if key not in _CHECKSUM_KEYS:
+            self.frame_kv[key] = val
+        self.line_count += 1
+
+        # Fallback runaway-protectie
+        if self.line_count > self.max_lines:
+            self.reset_frame()
+            return
+
+        # Einde van frame:
+        # 1) voorkeur: HSDS gezien (praktisch einde telegram)
+        # 2) alternatief: 'Checksum' gezien
+        # Met validate_checksum eindigt een frame alleen op 'Checksum' en moet de
+        # som van alle bytes (mod 256) nul zijn, anders wordt het frame weggegooid.
+        # Zonder validatie sluit HSDS het blok al af; de 'Checksum'-regel erna levert
+        # dan een leeg frame op, dat leveren we niet af.
+        if key in self.end_keys:
+            if self.validate_checksum and self.lrc != 0:
+                print("Checksum mismatch, frame dropped", flush=True)
+            elif self.frame_kv:
+                self.on_frame(self.frame_kv)
+            self.reset_frame()
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(exc)
@@ -3,8 +3,18 @@ import os
 import time
 import sys
 import signal
+import json
+import asyncio
 import serial
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+from vedirect_core import VEDirectProtocol
+
+try:
+    import orjson   # optioneel, sneller dan json
+except ImportError:
+    orjson = None
 
 # ---------- Config via env vars ----------
 SERIAL_PORT    = os.getenv("SERIAL_PORT", "/dev/ttyHS2")
@@ -17,21 +27,60 @@ MQTT_PASS      = os.getenv("MQTT_PASS", "")
 TOPIC_PREFIX   = os.getenv("TOPIC_PREFIX", "victron/mppt")
 AVAIL_TOPIC    = os.getenv("AVAIL_TOPIC", "victron/status")
 PUBLISH_RETAIN = os.getenv("RETAIN", "true").lower() in ("1", "true", "yes")
+VALIDATE_CHECKSUM = os.getenv("VALIDATE_CHECKSUM", "false").lower() in ("1", "true", "yes")
+PUBLISH_KEYS   = os.getenv("PUBLISH_KEYS", "true").lower() in ("1", "true", "yes")    # topic per key
+PUBLISH_JSON   = os.getenv("PUBLISH_JSON", "false").lower() in ("1", "true", "yes")   # heel frame als JSON op <prefix>/state
+MQTT_V5        = os.getenv("MQTT_V5", "false").lower() in ("1", "true", "yes")        # MQTT 5 met topic aliases
+MQTT_TOPIC_ALIASES = int(os.getenv("MQTT_TOPIC_ALIASES", "64"))                       # max aantal aliases dat we uitdelen
 
-# Keys die we niet willen publiceren (bevatten # of *)
-FORBIDDEN_KEY_CHARS = ("#", "*")
+# Alleen deze (stabiele) keys retained publiceren; snelle meetwaarden niet.
+# Leeg = alle keys volgen RETAIN. _ts en state volgen altijd RETAIN.
+RETAIN_KEYS = frozenset(k.strip() for k in os.getenv("RETAIN_KEYS", "FW,PID").split(",") if k.strip())
+# Eenmalige migratie: oude retained waarden (van toen alle keys retained waren) wissen
+# van de topics die nu niet meer retained zijn. Na één run mag dit weer uit.
+CLEAR_RETAINED = os.getenv("CLEAR_RETAINED", "false").lower() in ("1", "true", "yes")
 
 # Watchdogs
-FRAME_IDLE_TIMEOUT_S = int(os.getenv("FRAME_IDLE_TIMEOUT_S", "8"))   # reset buffer als er zolang geen regels kwamen
+FRAME_IDLE_TIMEOUT_S = int(os.getenv("FRAME_IDLE_TIMEOUT_S", "8"))   # reset buffer als er zolang geen regels kwamen (<= 0 = uit)
 FRAME_MAX_LINES      = int(os.getenv("FRAME_MAX_LINES", "128"))      # bescherm tegen runaway
 
+# Alleen gewijzigde waarden publiceren; een ongewijzigde key wordt na FULL_REPUBLISH_S
+# toch opnieuw verstuurd (0 = altijd alles)
+FULL_REPUBLISH_S     = int(os.getenv("FULL_REPUBLISH_S", "60"))
+
 # ---------- MQTT setup ----------
-client = mqtt.Client(client_id=f"victron-uart-{int(time.time())}", clean_session=True)
+if MQTT_V5:
+    client = mqtt.Client(client_id=f"victron-uart-{int(time.time())}", protocol=mqtt.MQTTv5)
+else:
+    client = mqtt.Client(client_id=f"victron-uart-{int(time.time())}", clean_session=True)
 client.will_set(AVAIL_TOPIC, "offline", retain=True)
 
 if MQTT_USER:
     client.username_pw_set(MQTT_USER, MQTT_PASS)
 
+# MQTT 5 topic aliases: per key één keer het volledige topic + alias, daarna alleen de
+# 2-byte alias. Aliases gelden per verbinding, dus bij (re)connect opnieuw aanleren.
+# De callbacks draaien in paho's netwerkthread: in plaats van een gedeelde set te
+# legen verhogen ze een generatie-teller. Een alias geldt alleen als hij in de
+# huidige generatie is aangeleerd; een reconnect tussen publish() en het opslaan
+# maakt hem dus vanzelf ongeldig.
+_alias_max = 0        # TopicAliasMaximum uit de CONNACK van de broker
+_alias_sent = {}      # key -> generatie waarin de broker de alias heeft geleerd
+_conn_gen = 0         # verhoogd bij elke connect/disconnect
+
+def on_connect(client, userdata, flags, reason_code, properties=None):
+    global _alias_max, _conn_gen
+    _alias_max = getattr(properties, "TopicAliasMaximum", 0)
+    _conn_gen += 1
+
+def on_disconnect(client, userdata, reason_code, properties=None):
+    global _conn_gen
+    _conn_gen += 1
+
+if MQTT_V5:
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+
 def mqtt_connect():
     while True:
         try:
@@ -45,33 +94,119 @@ def mqtt_connect():
             time.sleep(5)
 
 # ---------- Serial ----------
-def open_serial():
+async def open_serial(backoff_start: float = 0.1, backoff_max: float = 5.0):
+    # pyserial alleen voor openen/baudrate; lezen gaat direct op de fd (zie read_serial)
+    # Eerste poging direct, daarna exponentiële backoff 0.1s, 0.2s, 0.4s, ... tot max 5s
+    loop = asyncio.get_running_loop()
+    delay = backoff_start
     while True:
+        ser = None
         try:
-            ser = serial.Serial(SERIAL_PORT, BAUDRATE, timeout=1)
+            ser = serial.Serial(SERIAL_PORT, BAUDRATE, timeout=0)
+            ser.reset_input_buffer()   # verouderde bytes van vóór de storing weggooien
+            proto = VEDirectProtocol(on_frame, VALIDATE_CHECKSUM, FRAME_MAX_LINES)
+            loop.add_reader(ser.fileno(), read_serial, ser.fileno(), proto)
             print(f"Serial opened on {SERIAL_PORT} @ {BAUDRATE}", flush=True)
-            return ser
+            return ser, proto
         except Exception as e:
-            print(f"Serial open failed: {e}. Retry in 5s", flush=True)
-            time.sleep(5)
+            if ser is not None:
+                ser.close()   # poort was al open: fd niet lekken bij de volgende poging
+            print(f"Serial open failed: {e}. Retry in {delay:g}s", flush=True)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, backoff_max)
+
+def read_serial(fd: int, proto: VEDirectProtocol):
+    # Alles wat klaarstaat in één os.read, zonder pyserial's Serial.read()-laag
+    try:
+        data = os.read(fd, 4096)
+    except BlockingIOError:
+        return
+    except OSError as e:
+        proto.connection_lost(e)
+        return
+    if not data:
+        # leesbaar maar geen data: poort is weg (bv. USB-UART losgetrokken)
+        proto.connection_lost(serial.SerialException("device reports readiness to read but returned no data"))
+        return
+    proto.data_received(data)
 
 # ---------- Helpers ----------
-def parse_kv(line: str):
-    # VE.Direct: "KEY\tVALUE"
-    if "\t" not in line:
-        return None, None
-    k, v = line.split("\t", 1)
-    return k.strip(), v.strip()
+# Topic, retain-vlag en alias per key cachen: een MPPT stuurt steeds dezelfde keys
+_TOPIC_CACHE = {}
+_TS_TOPIC = f"{TOPIC_PREFIX}/_ts"
+_STATE_TOPIC = f"{TOPIC_PREFIX}/state"
+# Niet-retained topics waarvan het oude retained bericht nog gewist moet worden (CLEAR_RETAINED)
+_stale_retained = set()
+
+def topic_for(key: str) -> tuple:
+    entry = _TOPIC_CACHE.get(key)
+    if entry is None:
+        retain = PUBLISH_RETAIN and (not RETAIN_KEYS or key in RETAIN_KEYS)
+        alias = None
+        if MQTT_V5 and len(_TOPIC_CACHE) < MQTT_TOPIC_ALIASES:
+            alias = Properties(PacketTypes.PUBLISH)
+            alias.TopicAlias = len(_TOPIC_CACHE) + 1
+        entry = _TOPIC_CACHE[key] = (f"{TOPIC_PREFIX}/{key}", retain, alias)
+        if CLEAR_RETAINED and not retain:
+            _stale_retained.add(entry[0])
+    return entry
+
+def dump_json(obj: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+# Laatst verstuurde (waarde, tijdstip) per key, voor delta-publish
+_last_published = {}
 
-def is_forbidden_key(key: str) -> bool:
-    return any(ch in key for ch in FORBIDDEN_KEY_CHARS)
+def clear_retained(topic: str):
+    # Een leeg retained bericht wist de retained waarde op de broker. Gaat vóór de
+    # eerste echte waarde uit, zodat subscribers daarna niet op "" blijven staan.
+    if client.publish(topic, b"", 0, True).rc == mqtt.MQTT_ERR_SUCCESS:
+        _stale_retained.discard(topic)
 
 def publish_frame(frame: dict):
-    # filter verboden keys en publiceer
-    cleaned = {k: v for k, v in frame.items() if k and not is_forbidden_key(k)}
-    for k, v in cleaned.items():
-        client.publish(f"{TOPIC_PREFIX}/{k}", v, retain=PUBLISH_RETAIN)
-    client.publish(f"{TOPIC_PREFIX}/_ts", int(time.time()), retain=PUBLISH_RETAIN)
+    # frame bevat geen verboden keys meer (gefilterd bij het inlezen)
+    ts = int(time.time())
+    ts_payload = str(ts).encode("ascii")
+    publish = client.publish
+    if PUBLISH_KEYS:
+        now = time.monotonic()
+        for k, v in frame.items():
+            # per key beslissen, zodat elk blok/key zijn eigen inhaal-moment krijgt
+            last = _last_published.get(k)
+            if last is not None and last[0] == v and now - last[1] < FULL_REPUBLISH_S:
+                continue
+            topic, retain, alias = topic_for(k)
+            if _stale_retained and topic in _stale_retained:
+                clear_retained(topic)
+            if alias is None or alias.TopicAlias > _alias_max:
+                info = publish(topic, v, 0, retain)
+            else:
+                gen = _conn_gen
+                if _alias_sent.get(k) == gen:
+                    info = publish("", v, 0, retain, alias)
+                else:
+                    info = publish(topic, v, 0, retain, alias)
+                    if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                        _alias_sent[k] = gen
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                _last_published[k] = (v, now)
+        # _ts is de heartbeat: QoS 0, zodat paho tijdens een broker-storing geen
+        # verouderde timestamps opspaart om ze na de reconnect alsnog te versturen
+        publish(_TS_TOPIC, ts_payload, 0, PUBLISH_RETAIN)
+    if PUBLISH_JSON:
+        # één bericht per frame i.p.v. één per key
+        state = {k: v.decode("ascii", errors="ignore") for k, v in frame.items()}
+        state["_ts"] = ts
+        publish(_STATE_TOPIC, dump_json(state), 0, PUBLISH_RETAIN)
+
+def on_frame(frame: dict):
+    # paho's netwerkthread verstuurt, dus dit blokkeert de seriële kant niet
+    try:
+        publish_frame(frame)
+    except (OSError, ValueError) as e:
+        print(f"Publish error: {e}", flush=True)
 
 def graceful_exit(*_):
     try:
@@ -85,67 +220,45 @@ def graceful_exit(*_):
 signal.signal(signal.SIGINT, graceful_exit)
 signal.signal(signal.SIGTERM, graceful_exit)
 
-# ---------- Main loop (zonder checksum) ----------
-def main():
-    mqtt_connect()
-    ser = open_serial()
+# ---------- Main loop ----------
+async def idle_watchdog(proto: VEDirectProtocol):
+    # Idle watchdog: als te lang geen data → reset frame buffer.
+    # Slaapt tot de deadline i.p.v. elke seconde te pollen; de leeskant raakt hij niet.
+    while True:
+        idle_deadline = proto.last_line_ts + FRAME_IDLE_TIMEOUT_S
+        now = time.monotonic()
+        if now < idle_deadline:
+            await asyncio.sleep(idle_deadline - now)
+            continue
+        if proto.frame_kv:
+            proto.reset_frame()
+        await asyncio.sleep(FRAME_IDLE_TIMEOUT_S)
 
-    frame_kv = {}
-    last_line_ts = time.time()
-    line_count = 0
+async def async_main():
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, graceful_exit)
 
     while True:
+        ser, proto = await open_serial()
+        opened = time.monotonic()
+        # watchdog alleen met een positieve timeout, anders zou hij met sleep(0) rondspinnen
+        watchdog = asyncio.create_task(idle_watchdog(proto)) if FRAME_IDLE_TIMEOUT_S > 0 else None
         try:
-            raw = ser.readline()
-            now = time.time()
-
-            # Idle watchdog: als te lang geen data → reset frame buffer
-            if now - last_line_ts > FRAME_IDLE_TIMEOUT_S and frame_kv:
-                frame_kv.clear()
-                line_count = 0
-
-            if not raw:
-                # geen nieuwe regel, gewoon door
-                continue
-
-            last_line_ts = now
-            try:
-                line = raw.decode("utf-8", errors="ignore").strip()
-            except Exception:
-                continue
-            if not line:
-                continue
+            exc = await proto.closed
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            loop.remove_reader(ser.fileno())
+            ser.close()
+        print(f"Serial error: {exc}. Reopening port...", flush=True)
+        # direct heropenen, tenzij de poort meteen weer wegviel (geen busy-loop)
+        if time.monotonic() - opened < 1:
+            await asyncio.sleep(1)
 
-            key, val = parse_kv(line)
-            if key is None:
-                continue
-
-            # Bewaar key/value (filteren pas bij publish)
-            frame_kv[key] = val
-            line_count += 1
-
-            # Fallback runaway-protectie
-            if line_count > FRAME_MAX_LINES:
-                frame_kv.clear()
-                line_count = 0
-                continue
-
-            # Einde van frame:
-            # 1) voorkeur: HSDS gezien (praktisch einde telegram)
-            # 2) alternatief: 'Checksum' gezien (maar we valideren hem niet meer)
-            if key == "HSDS" or key.lower() == "checksum":
-                publish_frame(frame_kv)
-                frame_kv.clear()
-                line_count = 0
-
-        except serial.SerialException as e:
-            print(f"Serial error: {e}. Reopening port in 3s...", flush=True)
-            time.sleep(3)
-            ser = open_serial()
-            frame_kv.clear()
-            line_count = 0
-        except Exception as e:
-            print(f"Loop error: {e}", flush=True)
+def main():
+    mqtt_connect()
+    asyncio.run(async_main())
 
 if __name__ == "__main__":
     main()